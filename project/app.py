@@ -8,10 +8,16 @@ from flask import Flask, render_template, request, redirect, url_for, session, f
 import numpy as np
 import cv2
 import os
+from numba import config as numba_config, njit, prange
 from PIL import Image
 import webbrowser
-from threading import Timer
+import asyncio
+import queue
+import time
+from threading import Lock, Thread, Timer
+from concurrent.futures import Future, ThreadPoolExecutor
 import hashlib
+import hmac
 from dotenv import load_dotenv
 from datetime import datetime
 from functools import wraps
@@ -23,10 +29,13 @@ import database as db
 load_dotenv()
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
-app.secret_key = os.urandom(24)
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+# Templates iterate the columnar gallery data with zip()
+app.jinja_env.globals['zip'] = zip
+
 # Initialize SQLite database
 print("Initializing database...")
 try:
@@ -38,6 +47,45 @@ except Exception as e:
 # Ensure uploads folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+def lightness(gray):
+    """CIE L* of grayscale values scaled to [0, 1] (sRGB transfer curve)"""
+    linear = np.where(gray <= 0.04045, gray / 12.92, np.power((gray + 0.055) / 1.055, 2.4))
+    return np.where(linear > 0.008856, 116 * np.cbrt(linear) - 16, 903.3 * linear)
+
+# For gray pixels (R = G = B) the LAB L channel depends only on the gray
+# value, so L for 8-bit input is a 256-entry lookup
+L_LUT = lightness(np.arange(256) / 255.0).astype(np.float32)
+
+def input_tile(gray):
+    """Build the centered 224x224 L tile the network expects from an 8-bit grayscale image"""
+    L = L_LUT[cv2.resize(gray, (224, 224))]
+    np.subtract(L, 50, out=L)
+    return L
+
+def configure_backend(net):
+    """Pick the fastest available DNN backend for the loaded network.
+
+    A CUDA-enabled OpenCV build with a visible GPU runs the net in FP16 on
+    the device. Otherwise, OpenCV builds with OpenVINO expose the Inference
+    Engine backend, which repacks convolution weights into a blocked (NCHWc)
+    layout for SIMD-friendly CPU inference. Stock pip wheels ship without
+    either, so fall back to the built-in OpenCV CPU backend.
+    """
+    if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA_FP16)
+        return "CUDA (FP16)"
+
+    ie_targets = cv2.dnn.getAvailableTargets(cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE)
+    if cv2.dnn.DNN_TARGET_CPU in ie_targets:
+        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE)
+        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        return "OpenVINO (CPU)"
+
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return "OpenCV (CPU)"
+
 # Load colorization model
 try:
     prototxt = "models/models_colorization_deploy_v2.prototxt"
@@ -51,16 +99,123 @@ try:
     pts = pts.transpose().reshape(2, 313, 1, 1)
     net.getLayer(class8).blobs = [pts.astype("float32")]
     net.getLayer(conv8).blobs = [np.full([1, 313], 2.606, dtype="float32")]
-    print("Model loaded successfully")
+    backend = configure_backend(net)
+    print(f"Model loaded successfully ({backend} backend)")
 except Exception as e:
     print(f"Failed to load model: {e}")
     net = None
 
+# Batched inference
+# Concurrent uploads are coalesced into a single forward pass: each request
+# queues its 224x224 L tile and waits on a Future for its ab prediction.
+
+BATCH_MAX_SIZE = 8
+BATCH_WAIT_SECONDS = 0.05
+
+inference_queue = queue.Queue()
+
+# Reused input blob; only the inference worker thread writes to it
+input_blob = np.empty((BATCH_MAX_SIZE, 1, 224, 224), dtype=np.float32)
+
+def inference_worker():
+    """Run queued L tiles through the network in batches"""
+    while True:
+        batch = [inference_queue.get()]
+        deadline = time.monotonic() + BATCH_WAIT_SECONDS
+        while len(batch) < BATCH_MAX_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(inference_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        tiles, futures = zip(*batch)
+        try:
+            for i, tile in enumerate(tiles):
+                input_blob[i, 0] = tile
+            net.setInput(input_blob[:len(tiles)])
+            ab_batch = net.forward()
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            continue
+
+        for i, future in enumerate(futures):
+            future.set_result(ab_batch[i])
+
+def predict_ab(L):
+    """Queue an L tile for batched inference and wait for its ab channels"""
+    future = Future()
+    inference_queue.put((L, future))
+    return future.result()
+
+Thread(target=inference_worker, daemon=True).start()
+
+# Background disk writes so uploads don't wait on file I/O
+io_executor = ThreadPoolExecutor(max_workers=2)
+
 # Helper functions
 
-def hash_password(password):
-    """Hash password using SHA-256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+PBKDF2_ITERATIONS = 200_000
+
+# pbkdf2_hmac releases the GIL, so a pool sized to the core count lets
+# concurrent logins hash in parallel without starving other request threads
+kdf_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+# Long-lived threads for database calls from async views. Each async view
+# runs on a fresh asgiref thread, so calling the database there directly
+# (or through asyncio.to_thread) would open a new per-thread SQLite
+# connection on every request
+db_executor = ThreadPoolExecutor(max_workers=4)
+
+def run_db(func, *args):
+    """Run a database call on the long-lived DB thread pool (awaitable)"""
+    return asyncio.wrap_future(db_executor.submit(func, *args))
+
+def generate_salt():
+    """Generate a random per-user password salt (hex encoded)"""
+    return os.urandom(16).hex()
+
+# Salt for the decoy KDF run on failed lookups, so unknown emails cost the same
+DUMMY_SALT = generate_salt()
+
+def pbkdf2(password, salt):
+    """PBKDF2-HMAC-SHA256 of a password with a hex-encoded salt"""
+    return hashlib.pbkdf2_hmac(
+        'sha256', password.encode('utf-8'), bytes.fromhex(salt), PBKDF2_ITERATIONS
+    ).hex()
+
+async def hash_password(password, salt):
+    """Hash password with a per-user salt on the KDF thread pool"""
+    return await asyncio.wrap_future(kdf_executor.submit(pbkdf2, password, salt))
+
+async def verify_password(user, password):
+    """Check a password against a stored user record (None if not found).
+
+    Accounts created before salted hashes were introduced have no salt and
+    still hold a plain SHA-256 digest; those are verified the old way and
+    upgraded to PBKDF2 on the first successful login. Every path runs the
+    KDF once, so response time doesn't reveal which emails are registered.
+    """
+    if user is None:
+        await hash_password(password, DUMMY_SALT)
+        return False
+
+    salt = user.get('password_salt')
+    if salt:
+        return hmac.compare_digest(user['password_hash'], await hash_password(password, salt))
+
+    legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+    if not hmac.compare_digest(user['password_hash'], legacy_hash):
+        await hash_password(password, DUMMY_SALT)
+        return False
+
+    salt = generate_salt()
+    password_hash = await hash_password(password, salt)
+    await run_db(db.update_user_password, user['id'], password_hash, salt)
+    return True
 
 def login_required(f):
     """Decorator to require login for protected routes"""
@@ -72,6 +227,35 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Float LAB working set per output stripe; small enough to stay cache-resident
+# while still giving each parallel kernel launch enough rows to split
+STRIPE_BYTES = 4 * 1024 * 1024
+
+# Chroma (8-bit LAB a/b units) above which an upload counts as color. A tint
+# (sepia, cyanotype) has chroma along one hue that only scales with
+# brightness: it lies on one side of the mean hue axis with nothing off it,
+# so it is colorized. Complementary colors (blue sky over a yellow field) also
+# lie on that axis but on both sides of it.
+COLOR_CHROMA_THRESHOLD = 8
+
+def has_color(img):
+    """Check whether a BGR image already carries more than one hue, from a 64x64 thumbnail"""
+    thumb = cv2.resize(img, (64, 64), interpolation=cv2.INTER_AREA)
+    lab = cv2.cvtColor(thumb, cv2.COLOR_BGR2LAB)
+    chroma = lab[..., 1:].reshape(-1, 2).astype(np.float32) - 128
+
+    # Split chroma into the component along the mean hue and what lies off it
+    mean = chroma.mean(axis=0)
+    norm = np.linalg.norm(mean)
+    if norm > 1e-6:
+        direction = mean / norm
+        along = chroma @ direction
+        low, high = np.percentile(along, [5, 95])
+        if low < -COLOR_CHROMA_THRESHOLD and high > COLOR_CHROMA_THRESHOLD:
+            return True
+        chroma -= np.outer(along, direction)
+    return np.sqrt((chroma ** 2).sum(axis=1).mean()) > COLOR_CHROMA_THRESHOLD
+
 def colorizer(img):
     """Apply colorization to grayscale image using neural network"""
     try:
@@ -79,27 +263,25 @@ def colorizer(img):
         if len(img.shape) == 3:
             img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         
-        # Convert to RGB for processing
-        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        # Run neural network prediction (batched with concurrent uploads)
+        ab = predict_ab(input_tile(img))
         
-        # Normalize and convert to LAB color space
-        scaled = img.astype("float32") / 255.0
-        lab = cv2.cvtColor(scaled, cv2.COLOR_RGB2LAB)
-        resized = cv2.resize(lab, (224, 224))
-        L = cv2.split(resized)[0]
-        L -= 50
+        # Rebuild the image in horizontal stripes small enough for the float
+        # LAB buffer to stay in cache through merge, LAB->RGB and the 8-bit
+        # conversion; only the uint8 result is written at full resolution
+        height, width = img.shape
+        y0, y1, wy = linear_weights(height, ab.shape[1])
+        cols = linear_weights(width, ab.shape[2])
+        stripe_rows = max(1, STRIPE_BYTES // (width * 3 * 4))
+        stripe_buf = np.empty((min(stripe_rows, height), width, 3), dtype=np.float32)
+        colorized = np.empty((height, width, 3), dtype=np.uint8)
         
-        # Run neural network prediction
-        net.setInput(cv2.dnn.blobFromImage(L))
-        ab = net.forward()[0, :, :, :].transpose((1, 2, 0))
-        ab = cv2.resize(ab, (img.shape[1], img.shape[0]))
-        
-        # Merge L and ab channels
-        L = cv2.split(lab)[0]
-        colorized = np.concatenate((L[:, :, np.newaxis], ab), axis=2)
-        colorized = cv2.cvtColor(colorized, cv2.COLOR_LAB2RGB)
-        colorized = np.clip(colorized, 0, 1)
-        colorized = (255 * colorized).astype("uint8")
+        for top in range(0, height, stripe_rows):
+            rows = slice(top, top + stripe_rows)
+            stripe = stripe_buf[:len(y0[rows])]
+            merge_lab(img[rows], ab, (y0[rows], y1[rows], wy[rows]), cols, stripe)
+            cv2.cvtColor(stripe, cv2.COLOR_LAB2RGB, dst=stripe)
+            to_uint8(stripe, colorized[rows])
         
         return colorized
     except Exception as e:
@@ -107,6 +289,109 @@ def colorizer(img):
         traceback.print_exc()
         raise
 
+def linear_weights(dst_size, src_size):
+    """Source indices and weights for OpenCV-compatible bilinear resampling"""
+    f = (np.arange(dst_size) + 0.5) * (src_size / dst_size) - 0.5
+    i0 = np.floor(f).astype(np.int64)
+    f -= i0
+    f[i0 < 0] = 0
+    i0[i0 < 0] = 0
+    f[i0 >= src_size - 1] = 0
+    i0[i0 >= src_size - 1] = src_size - 1
+    i1 = np.minimum(i0 + 1, src_size - 1)
+    return i0, i1, f.astype(np.float32)
+
+# Kernels are launched from request threads. The TBB layer can hang the
+# process at exit in that case, and the workqueue layer is not thread-safe,
+# so pin workqueue and serialize launches. Each kernel already uses every
+# core, so concurrent requests simply take turns.
+numba_config.THREADING_LAYER = 'workqueue'
+kernel_lock = Lock()
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _merge_lab(gray, lut, ab, y0, y1, wy, x0, x1, wx, out):
+    for y in prange(out.shape[0]):
+        ya, yb, fy = y0[y], y1[y], wy[y]
+        for x in range(out.shape[1]):
+            xa, xb, fx = x0[x], x1[x], wx[x]
+            out[y, x, 0] = lut[gray[y, x]]
+            for c in range(2):
+                top = ab[c, ya, xa] + (ab[c, ya, xb] - ab[c, ya, xa]) * fx
+                bottom = ab[c, yb, xa] + (ab[c, yb, xb] - ab[c, yb, xa]) * fx
+                out[y, x, c + 1] = top + (bottom - top) * fy
+
+def merge_lab(gray, ab, rows, cols, out):
+    """Fill LAB stripe out with L from gray and ab bilinearly upsampled from (2, h, w).
+
+    rows and cols are the (index, index, weight) triples from linear_weights
+    for the stripe's output rows and the full output width.
+    """
+    y0, y1, wy = rows
+    x0, x1, wx = cols
+    with kernel_lock:
+        _merge_lab(gray, L_LUT, ab, y0, y1, wy, x0, x1, wx, out)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _to_uint8(src, dst):
+    for y in prange(src.shape[0]):
+        for x in range(src.shape[1]):
+            for c in range(src.shape[2]):
+                dst[y, x, c] = np.uint8(min(max(src[y, x, c], 0.0), 1.0) * 255)
+
+def to_uint8(src, dst):
+    """Clip float image src to [0, 1] and scale into uint8 dst in a single pass"""
+    with kernel_lock:
+        _to_uint8(src, dst)
+
+def write_file(path, data):
+    """Write bytes to disk atomically.
+
+    The bytes go to a temporary file in the same directory which is then
+    renamed over the final path, so the path is either missing or complete.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_colorized(path, colorized):
+    """Encode an RGB result and write it to disk"""
+    ext = os.path.splitext(path)[1]
+    # Fastest DEFLATE level; PNG encoding dominates on large images
+    params = [cv2.IMWRITE_PNG_COMPRESSION, 1] if ext.lower() == '.png' else []
+    ok, encoded = cv2.imencode(ext, cv2.cvtColor(colorized, cv2.COLOR_RGB2BGR), params)
+    if not ok:
+        raise Exception(f"cv2.imencode failed for {path}")
+    write_file(path, encoded.tobytes())
+
+def save_image_files(image_id, original_path, data, colorized_path, colorized):
+    """Write an image's files (runs on the I/O thread pool).
+
+    A colorized value of None means the upload already had color and its
+    original bytes are saved as the result. If either write fails, the
+    image's database row and any file already written are removed. Each
+    file appears at its final path only once fully written; the dashboard
+    retries images that are still being saved.
+    """
+    try:
+        write_file(original_path, data)
+        if colorized is None:
+            write_file(colorized_path, data)
+        else:
+            write_colorized(colorized_path, colorized)
+    except Exception as e:
+        print(f"Failed to save image {image_id}: {e}")
+        traceback.print_exc()
+        db.delete_user_image(image_id)
+        for path in (original_path, colorized_path):
+            if os.path.exists(path):
+                os.remove(path)
+
 def open_browser():
     """Auto-open browser on startup"""
     webbrowser.open_new('http://127.0.0.1:5000/')
@@ -121,31 +406,31 @@ def index():
 
     try:
         user_images = db.get_user_images(session['user_id'])
-        print(f"Loaded {len(user_images)} images for user {session['user_id']}")
+        print(f"Loaded {len(user_images['id'])} images for user {session['user_id']}")
     except Exception as e:
         print(f"Error fetching images: {e}")
         traceback.print_exc()
-        user_images = []
+        user_images = {}
         flash('Error loading your images.', 'error')
 
     return render_template('dashboard.html', user_name=session.get('user_name'), images=user_images)
 
 @app.route('/login', methods=['GET', 'POST'])
-def login():
+async def login():
     """User login"""
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
 
         try:
-            user = db.get_user_by_email(email)
+            user = await run_db(db.get_user_by_email, email)
 
-            if user and user['password_hash'] == hash_password(password):
+            if await verify_password(user, password):
                 session['user_id'] = user['id']
                 session['user_name'] = user['full_name']
                 session['user_email'] = user['email']
 
-                db.update_user_last_login(user['id'])
+                await run_db(db.update_user_last_login, user['id'])
 
                 flash('Welcome back!', 'success')
                 return redirect(url_for('index'))
@@ -160,7 +445,7 @@ def login():
     return render_template('login.html')
 
 @app.route('/signup', methods=['GET', 'POST'])
-def signup():
+async def signup():
     """User registration"""
     if request.method == 'POST':
         full_name = request.form.get('full_name')
@@ -177,14 +462,19 @@ def signup():
             return redirect(url_for('signup'))
 
         try:
-            existing_user = db.get_user_by_email(email)
+            # Hash while the email lookup runs instead of after it
+            salt = generate_salt()
+            existing_user, password_hash = await asyncio.gather(
+                run_db(db.get_user_by_email, email),
+                hash_password(password, salt)
+            )
 
             if existing_user:
                 flash('Email already registered. Please log in.', 'error')
                 return redirect(url_for('login'))
 
             user_id = str(uuid.uuid4())
-            db.create_user(user_id, full_name, email, hash_password(password))
+            await run_db(db.create_user, user_id, full_name, email, password_hash, salt)
 
             flash('Account created successfully! Please log in.', 'success')
             return redirect(url_for('login'))
@@ -208,22 +498,56 @@ def about():
     """About page"""
     return render_template('about.html')
 
+def process_upload(file, user_id):
+    """Colorize one uploaded file.
+
+    Returns its database row with the original bytes and colorized result
+    (None for uploads that already have color); nothing is written to disk
+    until the row has been recorded.
+    """
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    safe_filename = f"{user_id}_{timestamp}_{file.filename}"
+
+    # Read the upload once and decode it from memory
+    data = file.stream.read()
+    file_size = len(data)
+    print(f"File size: {file_size} bytes")
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise Exception(f"Failed to decode uploaded image {file.filename}")
+
+    # Already-color photos skip the network; their original bytes are saved
+    # as the result, so None is returned in place of a colorized array
+    if has_color(img):
+        print("Image already has color, skipping colorization")
+        colorized = None
+    else:
+        print("Applying colorization...")
+        colorized = colorizer(img)
+
+    row = (
+        str(uuid.uuid4()),
+        user_id,
+        file.filename,
+        f'uploads/{safe_filename}',
+        f'uploads/colorized_{safe_filename}',
+        file_size
+    )
+    return row, data, colorized
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload():
     """Handle image upload and colorization"""
     print("\n=== Processing Upload ===")
     
-    if 'file' not in request.files:
-        flash('No file selected.', 'error')
-        return redirect(url_for('index'))
-
-    file = request.files['file']
-    if file.filename == '':
+    files = [file for file in request.files.getlist('file') if file.filename != '']
+    if not files:
         flash('No file selected.', 'error')
         return redirect(url_for('index'))
 
-    if not file.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff')):
+    if not all(file.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff')) for file in files):
         flash('Invalid file type. Please upload an image.', 'error')
         return redirect(url_for('index'))
 
@@ -231,47 +555,50 @@ def upload():
         flash('Colorization model not available.', 'error')
         return redirect(url_for('index'))
 
-    try:
-        # Save original file
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        safe_filename = f"{session['user_id']}_{timestamp}_{file.filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-        file.save(filepath)
+    user_id = session['user_id']
 
-        file_size = os.path.getsize(filepath)
-        print(f"File size: {file_size} bytes")
+    def process(file):
+        try:
+            return process_upload(file, user_id)
+        except Exception as e:
+            print(f"Upload error for {file.filename}: {e}")
+            traceback.print_exc()
+            return None
 
-        # Read and colorize image
-        img = cv2.imread(filepath)
-        if img is None:
-            raise Exception(f"Failed to read image from {filepath}")
+    # Colorize files concurrently so their forward passes share a batch
+    with ThreadPoolExecutor(max_workers=BATCH_MAX_SIZE) as pool:
+        results = list(pool.map(process, files))
 
-        print("Applying colorization...")
-        colorized = colorizer(img)
+    processed = [result for result in results if result is not None]
+    failed = [file.filename for file, result in zip(files, results) if result is None]
 
-        # Save colorized image
-        colorized_filename = f"colorized_{safe_filename}"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], colorized_filename)
-        cv2.imwrite(output_path, cv2.cvtColor(colorized, cv2.COLOR_RGB2BGR))
-
-        # Save to database
-        image_id = str(uuid.uuid4())
-        db.create_user_image(
-            image_id,
-            session['user_id'],
-            file.filename,
-            f'uploads/{safe_filename}',
-            f'uploads/{colorized_filename}',
-            file_size
-        )
-
-        flash('Image colorized successfully!', 'success')
-        print("=== Upload Complete ===\n")
+    if processed:
+        try:
+            # Save to database, then write the files in the background
+            db.create_user_images_bulk([row for row, _, _ in processed])
+            for row, data, colorized in processed:
+                io_executor.submit(
+                    save_image_files,
+                    row[0],
+                    os.path.join('static', row[3]),
+                    data,
+                    os.path.join('static', row[4]),
+                    colorized
+                )
+
+            if len(processed) == 1:
+                flash('Image colorized successfully!', 'success')
+            else:
+                flash(f'{len(processed)} images colorized successfully!', 'success')
+            print("=== Upload Complete ===\n")
 
-    except Exception as e:
-        print(f"Upload error: {e}")
-        traceback.print_exc()
-        flash('An error occurred while processing your image.', 'error')
+        except Exception as e:
+            print(f"Upload error: {e}")
+            traceback.print_exc()
+            failed = [file.filename for file in files]
+
+    if failed:
+        flash(f"An error occurred while processing: {', '.join(failed)}", 'error')
 
     return redirect(url_for('index'))
 
@@ -6,16 +6,25 @@ Handles all database operations for the image colorization app
 
 import sqlite3
 import os
+import threading
 from contextlib import contextmanager
-from datetime import datetime
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'database.db')
 
+# Local-time ISO 8601 timestamp generated by SQLite itself
+SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')"
+
+# SQLite connections cannot be shared across threads, so each thread keeps its own
+_local = threading.local()
+
 def init_database():
     """Initialize database with required tables and indexes"""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
+    # WAL lets readers proceed while a writer is active (persists in the db file)
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     # Users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -23,10 +32,16 @@ def init_database():
             full_name TEXT NOT NULL,
             email TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
+            password_salt TEXT DEFAULT NULL,
             last_login TEXT DEFAULT NULL,
-            created_at TEXT DEFAULT NULL
+            created_at TEXT DEFAULT (%s)
         )
-    ''')
+    ''' % SQL_NOW)
+    
+    # Add salt column to databases created before salted password hashes
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(users)')]
+    if 'password_salt' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN password_salt TEXT DEFAULT NULL')
     
     # User images table
     cursor.execute('''
@@ -37,32 +52,48 @@ def init_database():
             original_image_path TEXT,
             colorized_image_path TEXT,
             file_size INTEGER,
-            created_at TEXT DEFAULT NULL,
+            created_at TEXT DEFAULT (%s),
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
-    ''')
+    ''' % SQL_NOW)
     
     # Performance indexes
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_images_user_id ON user_images(user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_images_user_created ON user_images(user_id, created_at DESC)')
+    # Covered by the (user_id, created_at) index's prefix
+    cursor.execute('DROP INDEX IF EXISTS idx_user_images_user_id')
     
     conn.commit()
     conn.close()
     print(f"Database initialized: {DB_PATH}")
 
-@contextmanager
-def get_db_connection():
-    """Database connection context manager"""
+def _connect():
+    """Open a new connection with per-connection pragmas applied.
+
+    Connections live for the whole thread, so sqlite3's per-connection
+    statement cache (default size) compiles each of the constant query
+    strings below once.
+    """
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-32000')
+    return conn
+
+@contextmanager
+def get_db_connection():
+    """Database connection context manager (reuses one connection per thread)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = _connect()
     try:
         yield conn
         conn.commit()
     except Exception as e:
         conn.rollback()
         raise e
-    finally:
-        conn.close()
 
 def get_user_by_email(email):
     """Retrieve user by email address"""
@@ -84,50 +115,66 @@ def get_user_by_id(user_id):
             return dict(row)
         return None
 
-def create_user(user_id, full_name, email, password_hash):
+def create_user(user_id, full_name, email, password_hash, password_salt):
     """Create new user account"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        created_at = datetime.now().isoformat()
         cursor.execute(
-            'INSERT INTO users (id, full_name, email, password_hash, created_at) VALUES (?, ?, ?, ?, ?)',
-            (user_id, full_name, email, password_hash, created_at)
+            f'INSERT INTO users (id, full_name, email, password_hash, password_salt, created_at) VALUES (?, ?, ?, ?, ?, {SQL_NOW})',
+            (user_id, full_name, email, password_hash, password_salt)
         )
         return user_id
 
+def update_user_password(user_id, password_hash, password_salt):
+    """Replace a user's password hash and salt"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE users SET password_hash = ?, password_salt = ? WHERE id = ?',
+            (password_hash, password_salt, user_id)
+        )
+
 def update_user_last_login(user_id):
     """Update user's last login timestamp"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        last_login = datetime.now().isoformat()
         cursor.execute(
-            'UPDATE users SET last_login = ? WHERE id = ?',
-            (last_login, user_id)
+            f'UPDATE users SET last_login = {SQL_NOW} WHERE id = ?',
+            (user_id,)
         )
 
 def get_user_images(user_id):
-    """Get all images for a user (newest first)"""
+    """Get all images for a user (newest first) as a dict of column lists"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        # Plain tuples: rows are transposed into columns, never used individually
+        cursor.row_factory = None
         cursor.execute(
             'SELECT * FROM user_images WHERE user_id = ? ORDER BY created_at DESC',
             (user_id,)
         )
         rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        columns = [col[0] for col in cursor.description]
+        if not rows:
+            return {name: [] for name in columns}
+        return {name: list(values) for name, values in zip(columns, zip(*rows))}
 
-def create_user_image(image_id, user_id, original_filename, original_image_path, colorized_image_path, file_size):
-    """Save image metadata to database"""
+def create_user_images_bulk(rows):
+    """Save metadata for several images in a single transaction.
+
+    Each row is (image_id, user_id, original_filename, original_image_path,
+    colorized_image_path, file_size).
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        created_at = datetime.now().isoformat()
-        cursor.execute(
-            '''INSERT INTO user_images 
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.executemany(
+            f'''INSERT INTO user_images 
                (id, user_id, original_filename, original_image_path, colorized_image_path, file_size, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (image_id, user_id, original_filename, original_image_path, colorized_image_path, file_size, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, {SQL_NOW})''',
+            rows
         )
-        return image_id
+        return [row[0] for row in rows]
 
 def get_user_image(image_id, user_id):
     """Retrieve specific image by ID"""
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Gunicorn Configuration
+Run with: gunicorn app:app
+"""
+
+import multiprocessing
+import os
+from dotenv import load_dotenv
+
+# Load .env here, before the defaults below, so its values win
+load_dotenv()
+
+bind = '127.0.0.1:5000'
+
+# Each worker process has its own copy of the model, and its OpenCV DNN and
+# Numba kernels are multi-threaded. Use a few workers and split the cores
+# between them, rather than one worker per core each spawning a thread per
+# core. Fewer workers also means more concurrent uploads per process to
+# fill an inference batch. The app is not preloaded: the inference worker
+# thread must be started after the fork.
+cores = multiprocessing.cpu_count()
+workers = max(1, cores // 4)
+worker_class = 'gthread'
+threads = 4
+preload_app = False
+
+compute_threads = max(1, cores // workers)
+os.environ.setdefault('NUMBA_NUM_THREADS', str(compute_threads))
+
+def post_fork(server, worker):
+    """Limit OpenCV's thread pool to this worker's share of the cores"""
+    import cv2
+    cv2.setNumThreads(compute_threads)
+
+# Workers must share the session signing key. Without SECRET_KEY in the
+# environment or .env, generate one here in the master process for all
+# workers; sessions then end on restart.
+if not os.environ.get('SECRET_KEY'):
+    print("SECRET_KEY is not set; sessions will not survive a restart")
+    os.environ['SECRET_KEY'] = os.urandom(24).hex()